@@ -0,0 +1,180 @@
+import os
+import threading
+from datetime import datetime
+import bson
+from bson import ObjectId
+from bson.errors import InvalidDocument
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+from pymongo.errors import BulkWriteError, PyMongoError
+from ratelimit import retry_after_header
+
+load_dotenv()
+
+CHAT_FLUSH_BATCH_SIZE = int(os.environ.get("CHAT_FLUSH_BATCH_SIZE", 50))
+CHAT_FLUSH_INTERVAL_SECS = float(os.environ.get("CHAT_FLUSH_INTERVAL_SECS", 1))
+CHAT_BUFFER_MAX_PENDING = int(os.environ.get("CHAT_BUFFER_MAX_PENDING", 1000))
+CHAT_BUFFER_PUT_TIMEOUT_SECS = float(os.environ.get("CHAT_BUFFER_PUT_TIMEOUT_SECS", 5))
+
+# MongoDB's maximum document size
+MAX_DOCUMENT_BYTES = 16 * 1024 * 1024
+
+DUPLICATE_KEY_ERROR = 11000
+# Per-document write errors worth retrying (network, failover and shutdown
+# errors); any other write error means the document can never be stored
+RETRYABLE_WRITE_ERRORS = {6, 7, 89, 91, 189, 262, 9001, 10107, 11600, 11602, 13435, 13436}
+
+
+def check_document(doc: dict):
+    # Raises InvalidDocument if the document can't be stored in MongoDB
+    if len(bson.encode(doc)) > MAX_DOCUMENT_BYTES:
+        raise InvalidDocument("document is larger than the maximum MongoDB document size")
+
+
+class ChatWriteBuffer:
+    # Write-behind buffer for chat messages. Documents are queued in memory and
+    # written with insert_many by a background thread once a batch fills up or
+    # the flush interval passes. Documents stay in `pending` until their insert
+    # succeeds so readers can merge them in (see pending_for).
+    def __init__(self, collection, batch_size=CHAT_FLUSH_BATCH_SIZE, interval=CHAT_FLUSH_INTERVAL_SECS,
+                 max_pending=CHAT_BUFFER_MAX_PENDING, put_timeout=CHAT_BUFFER_PUT_TIMEOUT_SECS):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.interval = interval
+        self.max_pending = max_pending
+        self.put_timeout = put_timeout
+        self.pending = []
+        self.cond = threading.Condition()
+        # Held for the whole of a flush so discard() can wait out an in-flight batch
+        self.flush_lock = threading.Lock()
+        self.stopping = False
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopping = False
+            self.thread = threading.Thread(target=self.run, name="chat-write-buffer", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        # Flush everything still queued, then stop the background thread
+        with self.cond:
+            self.stopping = True
+            self.cond.notify_all()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        while self.pending:
+            remaining = len(self.pending)
+            try:
+                self.flush()
+            except Exception as e:
+                print("Unexpected error while flushing chat messages:", e)
+                break
+            if len(self.pending) >= remaining:
+                print("Failed to flush", remaining, "chat messages on shutdown")
+                break
+
+    def add(self, doc: dict):
+        # _id is assigned up front so a message is never duplicated when a
+        # reader sees it both in the database and in the buffer
+        doc.setdefault("_id", ObjectId())
+        # MongoDB keeps datetimes to the millisecond; match it so a message reads
+        # back the same before and after it is flushed
+        timestamp = doc.get("timestamp")
+        if isinstance(timestamp, datetime):
+            doc["timestamp"] = timestamp.replace(microsecond=timestamp.microsecond // 1000 * 1000)
+        try:
+            check_document(doc)
+        except InvalidDocument as e:
+            raise HTTPException(
+                status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+                detail=f"Chat message can't be stored: {e}",
+            )
+        with self.cond:
+            if not self.cond.wait_for(lambda: len(self.pending) < self.max_pending, timeout=self.put_timeout):
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Chat storage is busy, please try again shortly.",
+                    headers=retry_after_header(self.interval),
+                )
+            self.pending.append(doc)
+            if len(self.pending) >= self.batch_size:
+                self.cond.notify_all()
+        return doc["_id"]
+
+    def pending_for(self, user_id):
+        with self.cond:
+            return [doc for doc in self.pending if doc.get("userID") == user_id]
+
+    def discard(self, user_id):
+        # Drop unflushed messages for a deleted user. Waits for any in-flight
+        # flush, so once this returns none of the user's messages can still be
+        # written and a following delete_many removes everything already stored.
+        with self.flush_lock, self.cond:
+            self.pending = [doc for doc in self.pending if doc.get("userID") != user_id]
+            self.cond.notify_all()
+
+    def run(self):
+        while True:
+            with self.cond:
+                self.cond.wait_for(lambda: self.stopping or len(self.pending) >= self.batch_size, timeout=self.interval)
+                if self.stopping:
+                    return
+            try:
+                flushed = self.flush()
+            except Exception as e:
+                print("Unexpected error while flushing chat messages:", e)
+                flushed = False
+            if not flushed:
+                # Back off instead of retrying the same batch straight away
+                with self.cond:
+                    self.cond.wait_for(lambda: self.stopping, timeout=self.interval)
+
+    def flush(self):
+        # Returns False if some of the batch could not be written; retryable
+        # documents stay queued for the next attempt
+        with self.flush_lock:
+            with self.cond:
+                batch = self.pending[:self.batch_size]
+            if not batch:
+                return True
+            done = {doc["_id"] for doc in batch}
+            ok = True
+            try:
+                self.collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                for err in e.details.get("writeErrors", []):
+                    # Duplicate keys are documents stored by an earlier, partially failed attempt
+                    if err.get("code") == DUPLICATE_KEY_ERROR:
+                        continue
+                    doc = batch[err["index"]]
+                    if err.get("code") in RETRYABLE_WRITE_ERRORS:
+                        done.discard(doc["_id"])
+                    else:
+                        print("Dropping chat message that can't be stored:", doc["_id"], err.get("errmsg"))
+                    ok = False
+            except InvalidDocument as e:
+                # Drop the documents that can't be encoded and retry the rest;
+                # any already sent are skipped as duplicates next time
+                print("Failed to encode chat messages:", e)
+                retry = set()
+                for doc in batch:
+                    try:
+                        check_document(doc)
+                        retry.add(doc["_id"])
+                    except InvalidDocument:
+                        print("Dropping chat message that can't be stored:", doc["_id"])
+                # If no single document is at fault the batch would fail forever, so drop it
+                if len(retry) < len(batch):
+                    done -= retry
+                else:
+                    print("Dropping", len(batch), "chat messages that can't be stored")
+                ok = False
+            except PyMongoError as e:
+                print("Failed to flush chat messages:", e)
+                return False
+            with self.cond:
+                self.pending = [doc for doc in self.pending if doc["_id"] not in done]
+                self.cond.notify_all()
+            return ok
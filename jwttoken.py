@@ -26,4 +26,5 @@ def verify_token(token:str,credentials_exception):
         token_data = main.TokenData(username=username)
     except JWTError:
         raise credentials_exception
+    return token_data
 
@@ -1,9 +1,9 @@
 import os
-import shutil
 import json
 from typing import Optional, List
 from dotenv import load_dotenv
-from fastapi import Depends, FastAPI, HTTPException, status, UploadFile, File, Form, Body
+from fastapi import Depends, FastAPI, HTTPException, status, UploadFile, File, Form, Body, Request
+from fastapi.responses import JSONResponse
 from pydantic import BaseModel, EmailStr
 from pymongo import MongoClient, DESCENDING, ReturnDocument
 from pymongo.server_api import ServerApi
@@ -11,9 +11,12 @@ from fastapi.security import OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
 from hashing import Hasher
 from jwttoken import create_access_token
+from oauth import optional_oauth2_scheme, token_username, get_optional_username
 from gemini import get_chatResponse, is_this_math_related, generate_quiz, evaluate_user_skill
+from ratelimit import check_rate_limits, client_address, work_queue
+from chatbuffer import ChatWriteBuffer
+from uploads import check_upload_size, check_quiz_message, stored_upload, UploadReaper
 from datetime import datetime
-from pathlib import Path
 from bson import ObjectId
 
 class QuestionAnswer(BaseModel):
@@ -25,6 +28,21 @@ class EvaluationRequest(BaseModel):
     responses: List[QuestionAnswer]
 
 app = FastAPI()
+
+# Runs before FastAPI parses the multipart body, so oversized or rate limited
+# quiz uploads are rejected without being received. Registered before CORS so
+# CORS stays the outermost middleware and these errors carry its headers.
+@app.middleware("http")
+async def guard_quiz_uploads(request: Request, call_next):
+    if request.method == "POST" and request.url.path == "/generatequiz":
+        try:
+            check_upload_size(request.headers)
+            username = token_username(await optional_oauth2_scheme(request))
+            check_rate_limits("generatequiz", client_address(request), username)
+        except HTTPException as e:
+            return JSONResponse({"detail": e.detail}, status_code=e.status_code, headers=e.headers)
+    return await call_next(request)
+
 origins = [
     "http://localhost:3000"
 ]
@@ -55,8 +73,18 @@ expertDB = db["expert"]
 beginnerQuizDB = db["beginner_quiz"]
 intermediateQuizDB = db["intermediate_quiz"]
 expertQuizDB = db["expert_quiz"]
-UPLOAD_DIR = "uploads"
-Path(UPLOAD_DIR).mkdir(exist_ok=True)
+chatBuffer = ChatWriteBuffer(chatDB)
+uploadReaper = UploadReaper()
+
+@app.on_event("startup")
+def start_background_workers():
+    chatBuffer.start()
+    uploadReaper.start()
+
+@app.on_event("shutdown")
+def stop_background_workers():
+    chatBuffer.stop()
+    uploadReaper.stop()
 
 class User(BaseModel):
     email: EmailStr
@@ -188,7 +216,10 @@ def delete_user(username: str):
             expertQuizDB
         ]
 
-        # Delete user-related documents from each collection
+        # Delete user-related documents from each collection. Discarding first
+        # waits out any in-flight chat flush so none of the user's messages
+        # can be written after delete_many.
+        chatBuffer.discard(userID)
         for collection in collections:
             collection.delete_many({"userID": userID})
         return {"message": f"User '{username}' has been deleted successfully."}
@@ -198,7 +229,8 @@ def delete_user(username: str):
     
 
 @app.post("/chat")
-def chat(prompt: ChatPrompt):
+def chat(prompt: ChatPrompt, request: Request, username: Optional[str] = Depends(get_optional_username)):
+    check_rate_limits("chat", client_address(request), username)
     try:
         user = usersDB.find_one({"username": prompt.userID})
         user_id = user["_id"]
@@ -207,9 +239,11 @@ def chat(prompt: ChatPrompt):
         msg["timestamp"] = datetime.now()
         msg["userrole"] = "user"
         msg["userID"] = user_id
-        chatDB.insert_one(msg)
-        print("Message inserted into chat collection:", msg)
-        response = get_chatResponse(prompt.prompt)
+        # Queue the prompt only once a slot is taken, so a shed request stores nothing
+        with work_queue.slot():
+            chatBuffer.add(msg)
+            print("Message queued for chat collection:", msg)
+            response = get_chatResponse(prompt.prompt)
         print("AI response received:", response)
         aiResponse = ChatPrompt(
             userrole="gemini",
@@ -217,13 +251,15 @@ def chat(prompt: ChatPrompt):
             timestamp=datetime.now(),
             prompt=response
         )
-        chatDB.insert_one({
+        chatBuffer.add({
             "userrole": aiResponse.userrole,
             "userID": ObjectId(aiResponse.userID),  
             "timestamp": aiResponse.timestamp,
             "prompt": aiResponse.prompt
         })
         return {"response": response}
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
 
@@ -243,26 +279,31 @@ def get_chats(username: str):
     try:
         user = usersDB.find_one({"username": username})
         user_id = user["_id"]
-        messages = chatDB.find({"userID": user_id}).sort("timestamp", 1)
-        formatted_messages = [reformat_chat_message(m) for m in messages]
+        # Snapshot the write buffer before querying so a message flushed in
+        # between is still picked up by the query
+        unflushed = chatBuffer.pending_for(user_id)
+        messages = {m["_id"]: m for m in chatDB.find({"userID": user_id})}
+        for m in unflushed:
+            messages.setdefault(m["_id"], m)
+        ordered = sorted(messages.values(), key=lambda m: m.get("timestamp") or datetime.min)
+        formatted_messages = [reformat_chat_message(m) for m in ordered]
         return formatted_messages
     except Exception as e:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail=str(e))
     
+# Size and rate limits are enforced by guard_quiz_uploads before the body is read
 @app.post("/generatequiz")
 def generate_quiz_from_pdf(file: UploadFile = File(...),message: Optional[str] = Form(None)):
     fileType = file.filename.split(".")[-1]
     if fileType not in ["pdf"]:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Unsupported file type. Only PDF and TXT files are allowed.")
-    
-    file_path = os.path.join(UPLOAD_DIR, file.filename)
-    with open(file_path, "wb") as buffer:
-        shutil.copyfileobj(file.file, buffer)
+    check_quiz_message(message)
 
-    if not is_this_math_related(file_path):
-        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The provided file is not math-related.")
-    
-    quiz = generate_quiz(file_path, message)
+    with stored_upload(file) as file_path, work_queue.slot():
+        if not is_this_math_related(file_path):
+            raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="The provided file is not math-related.")
+
+        quiz = generate_quiz(file_path, message)
     if not quiz:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Failed to generate quiz.")
     
@@ -371,8 +412,10 @@ def set_user_skill_level(username: str, skill_level: str):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/evaluate-skill")
-def evaluate_skill_user(req: EvaluationRequest):
-    return evaluate_user_skill(req)
+def evaluate_skill_user(req: EvaluationRequest, request: Request, username: Optional[str] = Depends(get_optional_username)):
+    check_rate_limits("evaluate-skill", client_address(request), username)
+    with work_queue.slot():
+        return evaluate_user_skill(req)
 
 @app.post("/awardbadge/{username}/{badge_name}")
 def award_badge(username: str, badge_name: str):
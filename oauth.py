@@ -1,7 +1,9 @@
+from typing import Optional
 from fastapi import Depends,HTTPException,status
 from jwttoken import verify_token
 from fastapi.security import OAuth2PasswordBearer
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login")
+optional_oauth2_scheme = OAuth2PasswordBearer(tokenUrl="login", auto_error=False)
 
 def get_current_user(token:str = Depends(oauth2_scheme)):
     credentials_exception = HTTPException(
@@ -10,4 +12,16 @@ def get_current_user(token:str = Depends(oauth2_scheme)):
         headers={"WWW-Authenticate": "Bearer"},
     )
 
-    return verify_token(token,credentials_exception)
\ No newline at end of file
+    return verify_token(token,credentials_exception)
+
+# Username from the bearer token, or None when the request has no valid token
+def token_username(token: Optional[str]):
+    if not token:
+        return None
+    try:
+        return get_current_user(token).username
+    except HTTPException:
+        return None
+
+def get_optional_username(token: Optional[str] = Depends(optional_oauth2_scheme)):
+    return token_username(token)
@@ -0,0 +1,158 @@
+import os
+import math
+import time
+import threading
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from dotenv import load_dotenv
+from fastapi import HTTPException, status
+
+load_dotenv()
+
+# Per-endpoint bucket settings: (capacity, refill tokens per second)
+RATE_LIMITS = {
+    "chat": (
+        float(os.environ.get("CHAT_RATE_BURST", 5)),
+        float(os.environ.get("CHAT_RATE_PER_MIN", 20)) / 60,
+    ),
+    "generatequiz": (
+        float(os.environ.get("QUIZ_RATE_BURST", 2)),
+        float(os.environ.get("QUIZ_RATE_PER_MIN", 4)) / 60,
+    ),
+    "evaluate-skill": (
+        float(os.environ.get("EVAL_RATE_BURST", 3)),
+        float(os.environ.get("EVAL_RATE_PER_MIN", 10)) / 60,
+    ),
+}
+
+# Every request is also charged to a bucket for its client address, so extra
+# accounts don't buy extra capacity. It is this many times larger than a user's
+# bucket because a campus NAT or proxy puts many students behind one address.
+ADDRESS_RATE_MULTIPLIER = float(os.environ.get("ADDRESS_RATE_MULTIPLIER", 10))
+
+# Global limits for expensive (LLM / OCR) work
+MAX_CONCURRENT_WORK = int(os.environ.get("MAX_CONCURRENT_WORK", 4))
+MAX_QUEUED_WORK = int(os.environ.get("MAX_QUEUED_WORK", 16))
+MAX_QUEUE_DELAY_SECS = float(os.environ.get("MAX_QUEUE_DELAY_SECS", 10))
+
+# Set when running behind a reverse proxy that appends the client address to
+# X-Forwarded-For; otherwise every user behind the proxy shares one address
+TRUST_FORWARDED_FOR = os.environ.get("TRUST_FORWARDED_FOR", "false").lower() == "true"
+
+# Buckets idle for this long are dropped so memory does not grow with every user seen
+BUCKET_IDLE_SECS = 3600
+
+
+class RateLimitBackend(ABC):
+    # Storage for token buckets. Subclass this (e.g. with a Redis backend) so
+    # several workers can share one view of each user's bucket.
+    @abstractmethod
+    def consume(self, key: str, capacity: float, refill_rate: float, cost: float = 1) -> float:
+        # Returns 0 if the tokens were taken, otherwise the seconds until they will be available
+        ...
+
+
+class InMemoryBackend(RateLimitBackend):
+    def __init__(self):
+        self.buckets = {}
+        self.lock = threading.Lock()
+        self.last_sweep = time.monotonic()
+
+    def consume(self, key, capacity, refill_rate, cost=1):
+        now = time.monotonic()
+        with self.lock:
+            if now - self.last_sweep > BUCKET_IDLE_SECS:
+                self.sweep(now)
+            tokens, updated = self.buckets.get(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated) * refill_rate)
+            if tokens >= cost:
+                self.buckets[key] = (tokens - cost, now)
+                return 0
+            self.buckets[key] = (tokens, now)
+            return (cost - tokens) / refill_rate if refill_rate > 0 else BUCKET_IDLE_SECS
+
+    def sweep(self, now):
+        self.buckets = {
+            key: (tokens, updated)
+            for key, (tokens, updated) in self.buckets.items()
+            if now - updated <= BUCKET_IDLE_SECS
+        }
+        self.last_sweep = now
+
+
+class WorkQueue:
+    # Bounds how much expensive work runs at once and how much may wait behind it.
+    # Anything that would wait longer than max_delay is shed instead of queued.
+    def __init__(self, max_concurrent: int, max_queued: int, max_delay: float):
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.max_queued = max_queued
+        self.max_delay = max_delay
+        self.waiting = 0
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def slot(self):
+        with self.lock:
+            if self.waiting >= self.max_queued:
+                raise overloaded(self.max_delay)
+            self.waiting += 1
+        try:
+            acquired = self.slots.acquire(timeout=self.max_delay)
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if not acquired:
+            raise overloaded(self.max_delay)
+        try:
+            yield
+        finally:
+            self.slots.release()
+
+
+def retry_after_header(seconds: float):
+    return {"Retry-After": str(max(1, math.ceil(seconds)))}
+
+
+def overloaded(retry_after: float):
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please try again shortly.",
+        headers=retry_after_header(retry_after),
+    )
+
+
+backend = InMemoryBackend()
+work_queue = WorkQueue(MAX_CONCURRENT_WORK, MAX_QUEUED_WORK, MAX_QUEUE_DELAY_SECS)
+
+
+def set_backend(new_backend: RateLimitBackend):
+    global backend
+    backend = new_backend
+
+
+def client_address(request):
+    if TRUST_FORWARDED_FOR:
+        # The last entry is the one added by our own proxy; earlier ones are client-supplied
+        forwarded = request.headers.get("x-forwarded-for", "").split(",")[-1].strip()
+        if forwarded:
+            return forwarded
+    return request.client.host if request.client else "unknown"
+
+
+def charge(key: str, capacity: float, refill_rate: float):
+    wait = backend.consume(key, capacity, refill_rate)
+    if wait > 0:
+        raise HTTPException(
+            status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+            detail="Too many requests, please slow down.",
+            headers=retry_after_header(wait),
+        )
+
+
+def check_rate_limits(endpoint: str, address: str, username: str = None):
+    # The user bucket is checked first so a user over their own limit doesn't
+    # also use up the address bucket shared with everyone behind the same NAT
+    capacity, refill_rate = RATE_LIMITS[endpoint]
+    if username:
+        charge(f"{endpoint}:user:{username}", capacity, refill_rate)
+    charge(f"{endpoint}:addr:{address}", capacity * ADDRESS_RATE_MULTIPLIER, refill_rate * ADDRESS_RATE_MULTIPLIER)
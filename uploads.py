@@ -0,0 +1,207 @@
+import os
+import time
+import shutil
+import hashlib
+import tempfile
+import threading
+from contextlib import contextmanager
+from pathlib import Path
+import fitz
+from dotenv import load_dotenv
+from fastapi import HTTPException, UploadFile, status
+
+load_dotenv()
+
+UPLOAD_DIR = os.environ.get("UPLOAD_DIR", "uploads")
+MAX_UPLOAD_BYTES = int(os.environ.get("MAX_UPLOAD_MB", 20)) * 1024 * 1024
+MAX_PDF_PAGES = int(os.environ.get("MAX_PDF_PAGES", 50))
+UPLOAD_MAX_AGE_SECS = float(os.environ.get("UPLOAD_MAX_AGE_HOURS", 24)) * 3600
+UPLOAD_DISK_QUOTA_BYTES = int(os.environ.get("UPLOAD_DISK_QUOTA_MB", 500)) * 1024 * 1024
+UPLOAD_REAP_INTERVAL_SECS = float(os.environ.get("UPLOAD_REAP_INTERVAL_SECS", 600))
+# The reaper never deletes a file used this recently, even to meet the quota.
+# Every worker runs its own reaper on the shared directory, so this (not
+# in_use) is what keeps a file alive while another worker's request reads it.
+UPLOAD_REAP_GRACE_SECS = float(os.environ.get("UPLOAD_REAP_GRACE_MINS", 30)) * 60
+MAX_QUIZ_MESSAGE_CHARS = int(os.environ.get("MAX_QUIZ_MESSAGE_CHARS", 4000))
+# Room for the multipart boundaries and the message field around the file
+MULTIPART_OVERHEAD_BYTES = 16 * 1024 + 4 * MAX_QUIZ_MESSAGE_CHARS
+CHUNK_SIZE = 1024 * 1024
+PDF_MAGIC = b"%PDF-"
+# PDF readers accept junk before the header as long as it starts within this many bytes
+PDF_MAGIC_SEARCH_BYTES = 1024
+PARTIAL_SUFFIX = ".part"
+
+Path(UPLOAD_DIR).mkdir(exist_ok=True)
+
+# Stored files currently being read by a request in this process; the reaper leaves these alone
+in_use = {}
+in_use_lock = threading.Lock()
+
+
+def bad_upload(detail: str, status_code=status.HTTP_400_BAD_REQUEST):
+    return HTTPException(status_code=status_code, detail=detail)
+
+
+def check_upload_size(headers):
+    # Checked before the request body is read. The server never reads past
+    # Content-Length, so this bounds how much of an upload reaches the temp dir.
+    length = headers.get("content-length")
+    if length is None:
+        raise bad_upload("Uploads must include a Content-Length header.", status.HTTP_411_LENGTH_REQUIRED)
+    if not length.isdigit():
+        raise bad_upload("Invalid Content-Length header.")
+    if int(length) > MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES:
+        raise bad_upload(
+            f"Upload is too large. The file may be at most {MAX_UPLOAD_BYTES // (1024 * 1024)} MB "
+            f"and the message at most {MAX_QUIZ_MESSAGE_CHARS} characters.",
+            status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+        )
+
+
+def check_quiz_message(message):
+    if message and len(message) > MAX_QUIZ_MESSAGE_CHARS:
+        raise bad_upload(f"Message is too long. The maximum is {MAX_QUIZ_MESSAGE_CHARS} characters.")
+
+
+def hash_upload(file: UploadFile):
+    # By the time the handler runs Starlette has already spooled the upload to
+    # a temporary file (bounded by check_upload_size and removed when the
+    # request ends). Hash it in place so content that is already stored is
+    # never written again. Returns the sha256 hex digest.
+    digest = hashlib.sha256()
+    size = 0
+    file.file.seek(0)
+    chunk = file.file.read(CHUNK_SIZE)
+    if PDF_MAGIC not in chunk[:PDF_MAGIC_SEARCH_BYTES]:
+        raise bad_upload("The uploaded file is not a valid PDF.")
+    while chunk:
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise bad_upload(
+                f"File is too large. The maximum size is {MAX_UPLOAD_BYTES // (1024 * 1024)} MB.",
+                status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            )
+        digest.update(chunk)
+        chunk = file.file.read(CHUNK_SIZE)
+    return digest.hexdigest()
+
+
+def store_upload(file: UploadFile, path: str):
+    # Copy the spooled upload into UPLOAD_DIR under `path`, validating it first
+    file.file.seek(0)
+    tmp = tempfile.NamedTemporaryFile(dir=UPLOAD_DIR, suffix=PARTIAL_SUFFIX, delete=False)
+    try:
+        with tmp:
+            shutil.copyfileobj(file.file, tmp, CHUNK_SIZE)
+        check_pdf(tmp.name)
+        # Another worker may store the same content at the same time; both copies are identical
+        os.replace(tmp.name, path)
+    except BaseException:
+        os.unlink(tmp.name)
+        raise
+
+
+def check_pdf(path: str):
+    try:
+        doc = fitz.open(path, filetype="pdf")
+    except Exception:
+        raise bad_upload("The uploaded file is not a valid PDF.")
+    try:
+        page_count = doc.page_count
+    finally:
+        doc.close()
+    if page_count == 0:
+        raise bad_upload("The uploaded PDF has no pages.")
+    if page_count > MAX_PDF_PAGES:
+        raise bad_upload(f"The uploaded PDF has too many pages. The maximum is {MAX_PDF_PAGES}.")
+
+
+@contextmanager
+def stored_upload(file: UploadFile):
+    # Store an uploaded PDF under its content hash and yield its path.
+    # Identical uploads share one file; it is protected from the reaper until
+    # the block exits, and for UPLOAD_REAP_GRACE_SECS in other workers.
+    content_hash = hash_upload(file)
+    path = os.path.join(UPLOAD_DIR, f"{content_hash}.pdf")
+    with in_use_lock:
+        in_use[path] = in_use.get(path, 0) + 1
+    try:
+        try:
+            # Refresh the age so every worker's reaper treats it as recently used
+            os.utime(path)
+        except FileNotFoundError:
+            # Not stored yet, or just reaped by another worker
+            store_upload(file, path)
+        yield path
+    finally:
+        with in_use_lock:
+            in_use[path] -= 1
+            if not in_use[path]:
+                del in_use[path]
+
+
+def reap_uploads():
+    # Delete stored uploads older than UPLOAD_MAX_AGE_SECS, then the oldest
+    # remaining ones until the directory fits in UPLOAD_DISK_QUOTA_BYTES.
+    # Files used within UPLOAD_REAP_GRACE_SECS are always kept.
+    now = time.time()
+    files = []
+    for entry in os.scandir(UPLOAD_DIR):
+        if not entry.is_file():
+            continue
+        try:
+            stat = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((stat.st_mtime, stat.st_size, entry.path))
+    files.sort()
+
+    total = sum(size for _, size, _ in files)
+    removed = 0
+    with in_use_lock:
+        for mtime, size, path in files:
+            if path in in_use:
+                continue
+            # Partial files belong to an upload still being copied unless they are stale
+            if path.endswith(PARTIAL_SUFFIX) and now - mtime <= UPLOAD_MAX_AGE_SECS:
+                continue
+            if now - mtime <= UPLOAD_REAP_GRACE_SECS:
+                continue
+            if now - mtime <= UPLOAD_MAX_AGE_SECS and total <= UPLOAD_DISK_QUOTA_BYTES:
+                continue
+            try:
+                os.unlink(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+            removed += 1
+    return removed
+
+
+class UploadReaper:
+    def __init__(self, interval=UPLOAD_REAP_INTERVAL_SECS):
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.thread is None:
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name="upload-reaper", daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                removed = reap_uploads()
+                if removed:
+                    print(f"Removed {removed} stored uploads")
+            except OSError as e:
+                print("Failed to clean up uploads:", e)
+            self.stopped.wait(self.interval)